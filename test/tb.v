@@ -7,9 +7,15 @@
 module tb ();
 
   // Dump the signals to a VCD file. You can view it with gtkwave or surfer.
+  // The file name can be changed with +vcd=<file>, e.g. for parallel runs,
+  // and dumping is skipped entirely with +nowaves.
+  reg [8*64-1:0] vcd_file;
   initial begin
-    $dumpfile("tb.vcd");
-    $dumpvars(0, tb);
+    if (!$test$plusargs("nowaves")) begin
+      if (!$value$plusargs("vcd=%s", vcd_file)) vcd_file = "tb.vcd";
+      $dumpfile(vcd_file);
+      $dumpvars(0, tb);
+    end
     #1;
   end
 
@@ -22,6 +28,133 @@ module tb ();
   wire [7:0] uo_out;
   wire [7:0] uio_out;
   wire [7:0] uio_oe;
+
+  // Bit 4 of the PWM output on its own, so cocotb can wait on its edges
+  wire pwm4 = uo_out[4];
+
+  // SPI master: when start rises, shifts the first frame_count frames of
+  // frame_queue (frame 0 in bits 15:0) out MSB first, so a whole batch of
+  // transactions costs cocotb a single trigger. Each frame is followed by
+  // 60 us (600 clock cycles) with nCS released for the peripheral to latch
+  // it, and done goes high after the last one.
+  localparam QUEUE_DEPTH = 8;
+  reg [16*QUEUE_DEPTH-1:0] frame_queue = {16*QUEUE_DEPTH{1'b0}};
+  reg [3:0] frame_count = 4'd0;
+  reg start = 1'b0;
+  reg done = 1'b0;
+  reg master_ncs = 1'b1;
+  reg master_copi = 1'b0;
+
+  // nCS and COPI come from the master while it is busy, otherwise from ui_in
+  wire spi_ncs = ui_in[2] & master_ncs;
+  wire spi_copi = master_ncs ? ui_in[1] : master_copi;
+
+  // SCLK is generated here instead of being toggled from cocotb. It idles
+  // low and runs in SPI mode 0 with a 10 us period while nCS is asserted.
+  reg sclk = 1'b0;
+  always begin
+    wait (spi_ncs == 1'b0);
+    #5000 sclk = !spi_ncs;
+    #5000 sclk = 1'b0;
+  end
+
+  integer f, i;
+  always @(posedge start) begin
+    done = 1'b0;
+    for (f = 0; f < frame_count; f = f + 1) begin
+      master_ncs = 1'b0;
+      for (i = 15; i >= 0; i = i - 1) begin
+        master_copi = frame_queue[16*f + i];
+        @(posedge sclk);
+        @(negedge sclk);
+      end
+      master_ncs = 1'b1;
+      #60000;
+    end
+    done = 1'b1;
+  end
+
+  // pwm_update_done pulses one PWM period (13 * 256 clock cycles, plus a
+  // margin for the SPI peripheral to latch the frame) after nCS is released,
+  // by which point the PWM counter has rolled over with the new settings.
+  localparam PWM_UPDATE_CYCLES = 13 * 256 + 16;
+  reg pwm_update_done = 1'b0;
+  reg spi_ncs_prev = 1'b1;
+  reg [12:0] settle_count = 13'd0;
+  always @(posedge clk) begin
+    spi_ncs_prev <= spi_ncs;
+    pwm_update_done <= 1'b0;
+    if (spi_ncs && !spi_ncs_prev) begin
+      settle_count <= PWM_UPDATE_CYCLES;
+    end else if (settle_count != 13'd0) begin
+      settle_count <= settle_count - 1;
+      if (settle_count == 13'd1) pwm_update_done <= 1'b1;
+    end
+  end
+
+  // PWM measurement on bit 4: a rising edge on meas_start arms it, then it
+  // counts clock cycles from the next rising edge of pwm4 to the falling edge
+  // (t_high) and to the following rising edge (t_period) and sets meas_valid.
+  localparam MEAS_IDLE = 2'd0;
+  localparam MEAS_WAIT_RISE = 2'd1;
+  localparam MEAS_HIGH = 2'd2;
+  localparam MEAS_LOW = 2'd3;
+  reg meas_start = 1'b0;
+  reg meas_start_prev = 1'b0;
+  reg meas_valid = 1'b0;
+  reg [1:0] meas_state = MEAS_IDLE;
+  reg [31:0] meas_count = 32'd0;
+  reg [31:0] t_high = 32'd0;
+  reg [31:0] t_period = 32'd0;
+  reg pwm4_prev = 1'b0;
+  always @(posedge clk) begin
+    meas_start_prev <= meas_start;
+    pwm4_prev <= pwm4;
+    meas_count <= meas_count + 1;
+    if (meas_start && !meas_start_prev) begin
+      meas_valid <= 1'b0;
+      meas_state <= MEAS_WAIT_RISE;
+    end else begin
+      case (meas_state)
+        MEAS_WAIT_RISE: if (pwm4 && !pwm4_prev) begin
+          meas_count <= 32'd1;
+          meas_state <= MEAS_HIGH;
+        end
+        MEAS_HIGH: if (!pwm4) begin
+          t_high <= meas_count;
+          meas_state <= MEAS_LOW;
+        end
+        MEAS_LOW: if (pwm4) begin
+          t_period <= meas_count;
+          meas_valid <= 1'b1;
+          meas_state <= MEAS_IDLE;
+        end
+        default: begin end
+      endcase
+    end
+  end
+
+  // Constant level checks on bit 4 for the 0% and 100% duty cycle tests:
+  // while check_low (check_high) is set, pwm4 going high (low) is reported
+  // and latched in check_fail, which clears once both checks are off.
+  reg check_low = 1'b0;
+  reg check_high = 1'b0;
+  reg check_fail = 1'b0;
+  always @(posedge clk) begin
+    if (!check_low && !check_high) begin
+      check_fail <= 1'b0;
+    end else if (!check_fail) begin
+      if (check_low && pwm4) begin
+        $error("0%% duty cycle failed: pwm4 went high");
+        check_fail <= 1'b1;
+      end
+      if (check_high && !pwm4) begin
+        $error("100%% duty cycle failed: pwm4 went low");
+        check_fail <= 1'b1;
+      end
+    end
+  end
+
 `ifdef GL_TEST
   wire VPWR = 1'b1;
   wire VGND = 1'b0;
@@ -36,7 +169,7 @@ module tb ();
       .VGND(VGND),
 `endif
 
-      .ui_in  (ui_in),    // Dedicated inputs
+      .ui_in  ({ui_in[7:3], spi_ncs, spi_copi, sclk}),  // Dedicated inputs
       .uo_out (uo_out),   // Dedicated outputs
       .uio_in (uio_in),   // IOs: Input path
       .uio_out(uio_out),  // IOs: Output path
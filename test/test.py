@@ -1,30 +1,72 @@
 # SPDX-FileCopyrightText: © 2024 Tiny Tapeout
 # SPDX-License-Identifier: Apache-2.0
 
+import os
+
 import cocotb
 from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge
+from cocotb.triggers import FallingEdge
 from cocotb.triggers import ClockCycles
+from cocotb.triggers import Timer
+from cocotb.triggers import ReadOnly
+from cocotb.triggers import NextTimeStep
+from cocotb.triggers import with_timeout
+from cocotb.result import SimTimeoutError
+from cocotb.utils import get_sim_time
 from cocotb.types import Logic
-from cocotb.types import LogicArray
-
-async def await_half_sclk(dut):
-    """Wait for the SCLK signal to go high or low."""
-    start_time = cocotb.utils.get_sim_time(units="ns")
-    while True:
-        await ClockCycles(dut.clk, 1)
-        # Wait for half of the SCLK period (10 us)
-        if (start_time + 100*100*0.5) < cocotb.utils.get_sim_time(units="ns"):
-            break
-    return
-
-def ui_in_logicarray(ncs, bit, sclk):
-    """Setup the ui_in value as a LogicArray."""
-    return LogicArray(f"00000{ncs}{bit}{sclk}")
 
-async def send_spi_transaction(dut, r_w, address, data):
+# Fixed number of cycles to wait for a PWM update, overrides pwm_update_done
+SETTLE_CYCLES = os.environ.get("SETTLE_CYCLES")
+
+async def await_pwm_update(dut):
+    """Wait until the last SPI write has taken effect on the PWM output."""
+    if SETTLE_CYCLES:
+        await ClockCycles(dut.clk, int(SETTLE_CYCLES))
+    else:
+        await RisingEdge(dut.pwm_update_done)
+
+async def reset(dut):
+    """Reset the DUT with nCS deasserted, holding reset for 5 clock cycles."""
+    dut.ena.value = 1
+    ncs = 1
+    bit = 0
+    dut.ui_in.value = (ncs << 2) | (bit << 1)
+    dut.rst_n.value = 0
+    await Timer(500, units="ns")
+    dut.rst_n.value = 1
+    await Timer(500, units="ns")
+
+async def bitbang_spi_frame(dut, frame):
+    """Clock a 16-bit frame out MSB first by driving nCS and COPI on ui_in."""
+    # Start transaction - pull CS low, SCLK is generated by the testbench
+    ncs = 0
+    bit = 0
+    # Set initial state with CS low
+    dut.ui_in.value = (ncs << 2) | (bit << 1)
+    # Shift the frame out MSB first, reusing the same edge triggers
+    sclk_rise = RisingEdge(dut.sclk)
+    sclk_fall = FallingEdge(dut.sclk)
+    for _ in range(16):
+        bit = (frame >> 15) & 0x1
+        frame <<= 1
+        # Set COPI while SCLK is low, it is sampled on the rising edge
+        dut.ui_in.value = (ncs << 2) | (bit << 1)
+        await sclk_rise
+        await sclk_fall
+    # End transaction - return CS high
+    ncs = 1
+    bit = 0
+    dut.ui_in.value = (ncs << 2) | (bit << 1)
+    # Give the peripheral 600 clock cycles to latch the frame
+    await Timer(60, units="us")
+
+# Number of frames the testbench SPI master can queue, see frame_queue in tb.v
+SPI_QUEUE_DEPTH = 8
+
+def spi_frame(r_w, address, data):
     """
-    Send an SPI transaction with format:
+    Build the 16-bit frame of an SPI transaction with format:
     - 1 bit for Read/Write
     - 7 bits for address
     - 8 bits for data
@@ -32,76 +74,117 @@ async def send_spi_transaction(dut, r_w, address, data):
     Parameters:
     - r_w: boolean, True for write, False for read
     - address: int, 7-bit address (0-127)
-    - data: LogicArray or int, 8-bit data
+    - data: int, 8-bit data (0-255)
     """
-    # Convert data to int if it's a LogicArray
-    if isinstance(data, LogicArray):
-        data_int = int(data)
-    else:
-        data_int = data
     # Validate inputs
-    if address < 0 or address > 127:
-        raise ValueError("Address must be 7-bit (0-127)")
-    if data_int < 0 or data_int > 255:
-        raise ValueError("Data must be 8-bit (0-255)")
-    # Combine RW and address into first byte
-    first_byte = (int(r_w) << 7) | address
-    # Start transaction - pull CS low
-    sclk = 0
-    ncs = 0
-    bit = 0
-    # Set initial state with CS low
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    await ClockCycles(dut.clk, 1)
-    # Send first byte (RW + Address)
-    for i in range(8):
-        bit = (first_byte >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-    # Send second byte (Data)
-    for i in range(8):
-        bit = (data_int >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-    # End transaction - return CS high
-    sclk = 0
-    ncs = 1
-    bit = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    await ClockCycles(dut.clk, 600)
-    return ui_in_logicarray(ncs, bit, sclk)
+    if not (0 <= address <= 127 and 0 <= data <= 255):
+        raise ValueError(f"Address must be 7-bit (0-127) and data 8-bit (0-255), got {address:#x}, {data:#x}")
+    # Combine RW, address and data into one 16-bit frame
+    return (int(r_w) << 15) | (address << 8) | data
+
+async def send_spi_transactions(dut, transactions):
+    """
+    Send a batch of SPI transactions, each an (r_w, address, data) tuple as
+    taken by spi_frame(). Up to SPI_QUEUE_DEPTH frames are queued in the
+    testbench SPI master at once and drained with a single await.
+    """
+    frames = [spi_frame(r_w, address, data) for r_w, address, data in transactions]
+    if os.environ.get("BITBANG"):
+        for frame in frames:
+            await bitbang_spi_frame(dut, frame)
+    else:
+        for start in range(0, len(frames), SPI_QUEUE_DEPTH):
+            batch = frames[start:start + SPI_QUEUE_DEPTH]
+            queue = 0
+            for n, frame in enumerate(batch):
+                queue |= frame << (16 * n)
+            # Hand the whole batch to the testbench SPI master
+            dut.frame_queue.value = queue
+            dut.frame_count.value = len(batch)
+            dut.start.value = 1
+            await with_timeout(RisingEdge(dut.done), len(batch), "ms")
+            # cocotb merges writes to one handle within a time step, so let
+            # start fall here or the next batch's start = 1 would replace it
+            dut.start.value = 0
+            await NextTimeStep()
+    return int(dut.ui_in.value)
+
+async def send_spi_transaction(dut, r_w, address, data):
+    """Send a single SPI transaction, see spi_frame() for the format."""
+    return await send_spi_transactions(dut, [(r_w, address, data)])
+
+async def configure_pwm(dut, duty):
+    """
+    Drive bits 4-7 high with PWM enabled at the given duty cycle.
+
+    The PWM tests don't verify SPI, so on RTL the registers are written
+    directly through the hierarchy. Gate-level netlists are flattened, so
+    there the registers are written over SPI instead.
+    """
+    try:
+        regs = dut.user_project.spi_peripheral_inst
+    except AttributeError:
+        await send_spi_transactions(dut, [(1, 0x00, 0xF0), (1, 0x02, 0xF0), (1, 0x04, duty)])
+        return
+    regs.en_reg_out_7_0.value = 0xF0
+    regs.en_reg_pwm_7_0.value = 0xF0
+    regs.pwm_duty_cycle.value = duty
+
+async def check_pwm_constant(dut, level):
+    """
+    Return whether bit 4 stays at level for 1 ms (10000 clock cycles),
+    using the check_low/check_high monitor in tb.v.
+    """
+    check = dut.check_high if level else dut.check_low
+    check.value = 1
+    await Timer(1, units="ms")
+    # Sample after the clock edge has settled, not the pre-edge value
+    await ReadOnly()
+    failed = int(dut.check_fail.value)
+    # Leave the read-only phase before driving the DUT again
+    await NextTimeStep()
+    check.value = 0
+    return not failed
+
+# Clock period used by all tests, tb.v measures the PWM in clock cycles
+CLK_PERIOD_NS = 100
+
+# Longest wait for a PWM measurement, the PWM period is about 0.33 ms
+PWM_TIMEOUT_MS = 10
+
+async def measure_pwm(dut):
+    """
+    Measure one PWM cycle on bit 4 with the counters in tb.v, which count
+    clock cycles from a rising edge to the falling edge and to the next
+    rising edge.
+
+    Returns (high_time, period) in ns.
+    """
+    dut.meas_start.value = 1
+    try:
+        await with_timeout(RisingEdge(dut.meas_valid), PWM_TIMEOUT_MS, "ms")
+    except SimTimeoutError:
+        assert False, f"No PWM cycle on bit 4 within {PWM_TIMEOUT_MS} ms " \
+            f"(at {get_sim_time('ns')} ns)"
+    await ReadOnly()
+    high_time = int(dut.t_high.value) * CLK_PERIOD_NS
+    period = int(dut.t_period.value) * CLK_PERIOD_NS
+    # Leave the read-only phase before driving the DUT again
+    await NextTimeStep()
+    dut.meas_start.value = 0
+    return high_time, period
 
 @cocotb.test()
 async def test_spi(dut):
     dut._log.info("Start SPI test")
 
     # Set the clock period to 100 ns (10 MHz)
-    clock = Clock(dut.clk, 100, units="ns")
+    clock = Clock(dut.clk, CLK_PERIOD_NS, units="ns")
     cocotb.start_soon(clock.start())
 
     # Reset
     dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await reset(dut)
 
     dut._log.info("Test project behavior")
     dut._log.info("Write transaction, address 0x00, data 0xF0")
@@ -133,99 +216,42 @@ async def test_spi(dut):
 
     dut._log.info("Write transaction, address 0x04, data 0xCF")
     ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0xCF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await await_pwm_update(dut)
 
     dut._log.info("Write transaction, address 0x04, data 0xFF")
     ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0xFF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await await_pwm_update(dut)
 
     dut._log.info("Write transaction, address 0x04, data 0x00")
     ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0x00)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await await_pwm_update(dut)
 
     dut._log.info("Write transaction, address 0x04, data 0x01")
     ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0x01)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await await_pwm_update(dut)
 
     dut._log.info("SPI test completed successfully")
 
 @cocotb.test()
 async def test_pwm_freq(dut):
     # Set the clock period to 100 ns (10 MHz)
-    clock = Clock(dut.clk, 100, units="ns")
+    clock = Clock(dut.clk, CLK_PERIOD_NS, units="ns")
     cocotb.start_soon(clock.start())
 
     # Reset
     dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await reset(dut)
 
     dut._log.info("PWM frequency test")
 
-    # Configure output register (bits 4-7 high)
-    await send_spi_transaction(dut, 1, 0x00, 0xF0)
-
-    # Enable PWM on bits 4-7
-    await send_spi_transaction(dut, 1, 0x02, 0xF0)
-
-    # Set 50% duty cycle
-    await send_spi_transaction(dut, 1, 0x04, 0x80)
+    # Enable PWM with 50% duty cycle on bits 4-7
+    await configure_pwm(dut, 0x80)
 
     # Wait for PWM to stabilize
     await ClockCycles(dut.clk, 5000)
 
-    # Wait for bit 4 to go low first (start from known state)
-    max_wait = 100000
-    wait_count = 0
-    while wait_count < max_wait:
-        await ClockCycles(dut.clk, 1)
-        curr_val = (int(dut.uo_out.value) >> 4) & 1
-        if curr_val == 0:
-            break
-        wait_count += 1
-
-    # Wait for first rising edge and capture time
-    prev_val = 0
-    wait_count = 0
-    while wait_count < max_wait:
-        await ClockCycles(dut.clk, 1)
-        curr_val = (int(dut.uo_out.value) >> 4) & 1
-        if prev_val == 0 and curr_val == 1:
-            time_first_edge = cocotb.utils.get_sim_time(units='ns')
-            break
-        prev_val = curr_val
-        wait_count += 1
-
-    # Wait for the signal to go back low (falling edge)
-    wait_count = 0
-    while wait_count < max_wait:
-        await ClockCycles(dut.clk, 1)
-        curr_val = (int(dut.uo_out.value) >> 4) & 1
-        if curr_val == 0:
-            break
-        wait_count += 1
-
-    # Wait for second rising edge and capture time
-    prev_val = 0
-    wait_count = 0
-    while wait_count < max_wait:
-        await ClockCycles(dut.clk, 1)
-        curr_val = (int(dut.uo_out.value) >> 4) & 1
-        if prev_val == 0 and curr_val == 1:
-            time_second_edge = cocotb.utils.get_sim_time(units='ns')
-            break
-        prev_val = curr_val
-        wait_count += 1
-    
-    # Calculate the period
-    period = time_second_edge - time_first_edge
+    # Measure the period
+    _, period = await measure_pwm(dut)
     dut._log.info(f"PWM Period: {period} ns")
 
     # Calculate frequency (convert from ns period to Hz)
@@ -243,20 +269,12 @@ async def test_pwm_freq(dut):
 @cocotb.test()
 async def test_pwm_duty(dut):
     # Set the clock period to 100 ns (10 MHz)
-    clock = Clock(dut.clk, 100, units="ns")
+    clock = Clock(dut.clk, CLK_PERIOD_NS, units="ns")
     cocotb.start_soon(clock.start())
 
     # Reset
     dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await reset(dut)
 
     dut._log.info("PWM duty cycle test")
 
@@ -270,65 +288,14 @@ async def test_pwm_duty(dut):
     for duty_value, expected_duty_percent in test_cases:
         dut._log.info(f"Testing duty cycle: {duty_value:#04x} (expected {expected_duty_percent}%)")
 
-        # Configure output register (bits 4-7 high)
-        await send_spi_transaction(dut, 1, 0x00, 0xF0)
-
-        # Enable PWM on bits 4-7
-        await send_spi_transaction(dut, 1, 0x02, 0xF0)
-
-        # Set duty cycle
-        await send_spi_transaction(dut, 1, 0x04, duty_value)
+        # Enable PWM with this duty cycle on bits 4-7
+        await configure_pwm(dut, duty_value)
 
         # Wait for PWM to stabilize
         await ClockCycles(dut.clk, 5000)
 
-        # Wait for bit 4 to go low first (start from known state)
-        max_wait = 100000
-        wait_count = 0
-        while wait_count < max_wait:
-            await ClockCycles(dut.clk, 1)
-            curr_val = (int(dut.uo_out.value) >> 4) & 1
-            if curr_val == 0:
-                break
-            wait_count += 1
-
-        # Wait for rising edge and capture time
-        prev_val = 0
-        wait_count = 0
-        while wait_count < max_wait:
-            await ClockCycles(dut.clk, 1)
-            curr_val = (int(dut.uo_out.value) >> 4) & 1
-            if prev_val == 0 and curr_val == 1:
-                t_rising_edge = cocotb.utils.get_sim_time(units='ns')
-                break
-            prev_val = curr_val
-            wait_count += 1
-
-        # Wait for falling edge and capture time
-        wait_count = 0
-        while wait_count < max_wait:
-            await ClockCycles(dut.clk, 1)
-            curr_val = (int(dut.uo_out.value) >> 4) & 1
-            if curr_val == 0:
-                t_falling_edge = cocotb.utils.get_sim_time(units='ns')
-                break
-            wait_count += 1
-
-        # Wait for next rising edge to calculate period
-        prev_val = 0
-        wait_count = 0
-        while wait_count < max_wait:
-            await ClockCycles(dut.clk, 1)
-            curr_val = (int(dut.uo_out.value) >> 4) & 1
-            if prev_val == 0 and curr_val == 1:
-                t_next_rising_edge = cocotb.utils.get_sim_time(units='ns')
-                break
-            prev_val = curr_val
-            wait_count += 1
-
-        # Calculate high time and period
-        high_time = t_falling_edge - t_rising_edge
-        period = t_next_rising_edge - t_rising_edge
+        # Measure high time and period
+        high_time, period = await measure_pwm(dut)
 
         # Calculate duty cycle percentage
         duty_cycle_percent = (high_time / period) * 100.0
@@ -343,37 +310,21 @@ async def test_pwm_duty(dut):
 
     # Test 0% duty cycle - signal should always be low
     dut._log.info("Testing duty cycle: 0x00 (expected 0%)")
-    await send_spi_transaction(dut, 1, 0x00, 0xF0)
-    await send_spi_transaction(dut, 1, 0x02, 0xF0)
-    await send_spi_transaction(dut, 1, 0x04, 0x00)
+    await configure_pwm(dut, 0x00)
     await ClockCycles(dut.clk, 5000)
 
     # Check that bit 4 remains low for an extended period
-    all_low = True
-    for _ in range(10000):
-        await ClockCycles(dut.clk, 1)
-        curr_val = (int(dut.uo_out.value) >> 4) & 1
-        if curr_val == 1:
-            all_low = False
-            break
+    all_low = await check_pwm_constant(dut, 0)
     assert all_low, "0% duty cycle failed: signal went high"
     dut._log.info("0% duty cycle verified: signal stayed low")
 
     # Test 100% duty cycle - signal should always be high
     dut._log.info("Testing duty cycle: 0xff (expected 100%)")
-    await send_spi_transaction(dut, 1, 0x00, 0xF0)
-    await send_spi_transaction(dut, 1, 0x02, 0xF0)
-    await send_spi_transaction(dut, 1, 0x04, 0xFF)
+    await configure_pwm(dut, 0xFF)
     await ClockCycles(dut.clk, 5000)
 
     # Check that bit 4 remains high for an extended period
-    all_high = True
-    for _ in range(10000):
-        await ClockCycles(dut.clk, 1)
-        curr_val = (int(dut.uo_out.value) >> 4) & 1
-        if curr_val == 0:
-            all_high = False
-            break
+    all_high = await check_pwm_constant(dut, 1)
     assert all_high, "100% duty cycle failed: signal went low"
     dut._log.info("100% duty cycle verified: signal stayed high")
 